@@ -1,21 +1,58 @@
 # app.py
-from flask import Flask, render_template, request, session, redirect, url_for
+from flask import Flask, render_template, request, session, redirect, url_for, Response, stream_with_context, jsonify
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
 import os
-import uuid
+import secrets
 import json
+import orjson
+import copy
+import random
+import functools
+import hashlib
+import threading
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
 import datetime
 import time
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
 from huggingface_hub import InferenceClient
+from huggingface_hub.utils import HfHubHTTPError
+import httpx2
+try:
+    # Private API (verified against huggingface_hub 2.2): lets batched requests use
+    # the same provider routing as InferenceClient. Without it batching is skipped.
+    from huggingface_hub.inference._providers import get_provider_helper
+except ImportError:
+    get_provider_helper = None
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Load environment variables from .env file
 load_dotenv()
 
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, which also serializes datetimes natively"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # Initialize Flask application
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
-app.config['SESSION_TYPE'] = 'filesystem'
+app.json = OrjsonProvider(app)
+# Stable key so session cookies survive restarts and are valid on every worker
+app.secret_key = os.getenv('FLASK_SECRET_KEY')
+if not app.secret_key:
+    raise ValueError("FLASK_SECRET_KEY environment variable not set. Please set it in your .env file.")
+
+# Compress HTML and JSON responses; the SSE chat stream's mimetype is left alone
+app.config['COMPRESS_MIN_SIZE'] = 500
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+Compress(app)
 
 # --- IMPROVED HUGGING FACE CONFIGURATION ---
 HF_TOKEN = os.getenv('HF_TOKEN')
@@ -31,31 +68,72 @@ AVAILABLE_MODELS = [
     "HuggingFaceH4/zephyr-7b-beta"
 ]
 
+# Shared HTTP session so every inference call reuses pooled keep-alive connections
+# instead of paying a fresh TCP + TLS handshake. 503 (model loading) is handled below.
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 504],
+        allowed_methods=None,
+        raise_on_status=False
+    )
+))
+
+# Batched requests get exactly one attempt and no adapter retries: a failed
+# batch falls back to per-prompt calls, which do their own backoff, instead of
+# retrying while it holds an inference slot
+batch_http_session = requests.Session()
+batch_http_session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=50, max_retries=0))
+
+# (connect, read) timeouts: fail fast on an unreachable host, but give generation time to finish
+REQUEST_TIMEOUT = (3.05, 30)
+PROBE_TIMEOUT = (3.05, 10)
+
+# Cap concurrent inference calls per process so bursts of students queue here
+# instead of turning into 429s from the API
+HF_MAX_CONCURRENCY = int(os.getenv('HF_MAX_CONCURRENCY', '4'))
+inference_slots = threading.BoundedSemaphore(HF_MAX_CONCURRENCY)
+
+MAX_BACKOFF_SECONDS = 30
+
+def backoff_delay(attempt, hint=None):
+    """Seconds to wait before retrying: the server's hint if given, else exponential"""
+    try:
+        if hint is not None:
+            return min(float(hint), MAX_BACKOFF_SECONDS)
+    except ValueError:
+        pass
+    return min(2 ** (attempt + 1), MAX_BACKOFF_SECONDS)
+
 # Function to test model availability
-def test_model_availability(model_name, max_retries=2):
-    """Test if a model is available and working"""
-    headers = {"Authorization": f"Bearer {HF_TOKEN}"}
-    api_url = f"https://api-inference.huggingface.co/models/{model_name}"
-    
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(
-                api_url,
-                headers=headers,
-                json={"inputs": "Hello, this is a test."},
-                timeout=10
-            )
-            if response.status_code == 200:
-                return True
-            elif response.status_code == 503:
-                # Model is loading, wait and retry
-                time.sleep(5)
-                continue
-        except Exception:
-            pass
-    return False
-
-# Find the first available model
+def test_model_availability(model_name):
+    """Check the model's Hub status; this does not run (or count against quota for) the model"""
+    try:
+        response = http_session.get(
+            f"https://huggingface.co/api/models/{model_name}",
+            headers={"Authorization": f"Bearer {HF_TOKEN}"},
+            params=[("expand[]", "inference"), ("expand[]", "inferenceProviderMapping")],
+            timeout=PROBE_TIMEOUT
+        )
+        if response.status_code != 200:
+            return False
+        info = response.json()
+        if info.get('inference') == 'warm':
+            return True
+        # Otherwise some inference provider must be serving it live; a repo with
+        # no deployment has no mapping at all
+        mapping = info.get('inferenceProviderMapping') or {}
+        providers = mapping.values() if isinstance(mapping, dict) else mapping
+        return any(isinstance(provider, dict) and provider.get('status') == 'live' for provider in providers)
+    except Exception:
+        return False
+
+# Find the first available model (probed at most once per process)
+@functools.lru_cache(maxsize=1)
 def get_working_model():
     """Get the first working model from the list"""
     for model in AVAILABLE_MODELS:
@@ -68,74 +146,571 @@ def get_working_model():
     app.logger.warning("No models available, using fallback")
     return "microsoft/DialoGPT-small"
 
-# Get working model
-WORKING_MODEL = get_working_model()
+# Configured model; the alternatives are only probed if it turns out to be unavailable
+WORKING_MODEL = os.getenv('HF_MODEL') or AVAILABLE_MODELS[0]
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after `ttl` seconds"""
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            # Reclaim expired entries at the least recently used end, so ones that
+            # are never read again don't wait for the size limit to push them out
+            while self._data:
+                expires_at = next(iter(self._data.values()))[1]
+                if expires_at is None or expires_at >= time.time():
+                    break
+                self._data.popitem(last=False)
+    
+    # Dict-style access, so it can stand in for the in-memory stores below
+    def __contains__(self, key):
+        return self.get(key) is not None
+    
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+    
+    def __setitem__(self, key, value):
+        self.set(key, value)
+    
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        with self._lock:
+            self._data.pop(key, None)
+        return value
+
+# Raw model replies keyed by (model, prompt, params). Sampled calls keep a few
+# variants per key so repeated prompts don't always get the identical reply.
+response_cache = TTLCache(maxsize=2048, ttl=3600)
+RESPONSE_VARIANTS = 3
 
-# Improved HF client with error handling
+# Concurrent generate calls wait up to HF_BATCH_WINDOW_MS for company and are then sent
+# to the API as one list-of-inputs request (0 disables batching)
+HF_BATCH_WINDOW_MS = int(os.getenv('HF_BATCH_WINDOW_MS', '20'))
+HF_MAX_BATCH = int(os.getenv('HF_MAX_BATCH', '8'))
+
+# Marks a prompt whose batch failed, so its caller should send it on its own
+_UNBATCHED = object()
+
+class InferenceBatcher:
+    """Groups prompts with identical generation params into one inference request
+    
+    The first caller of a batch leads it: it waits up to `max_wait_ms` for
+    company on its own thread and then sends the batch, so no extra threads
+    are started. A call made while no other generate call is running is sent
+    straight away, since there is nothing to wait for.
+    """
+    def __init__(self, client, max_batch, max_wait_ms, max_failures=3):
+        self.client = client
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.max_failures = max_failures
+        self.enabled = True
+        self._failures = 0
+        self._active = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+    
+    def submit(self, prompt, max_tokens, temperature, max_retries):
+        # Only prompts with the same params can share a request
+        key = (max_tokens, temperature)
+        future = Future()
+        batch = None
+        leader = False
+        with self._lock:
+            if self.enabled and self._active > 0:
+                batch = self._pending.get(key)
+                if batch is None:
+                    batch = self._pending[key] = ([], threading.Event())
+                    leader = True
+                items, full = batch
+                items.append((prompt, future))
+                if len(items) >= self.max_batch:
+                    del self._pending[key]
+                    full.set()
+            self._active += 1
+        
+        try:
+            if batch is None:
+                return self.client._generate(prompt, max_tokens, temperature, max_retries)
+            
+            if leader:
+                items, full = batch
+                full.wait(self.max_wait)
+                with self._lock:
+                    # It may already be gone because it filled up
+                    if self._pending.get(key) is batch:
+                        del self._pending[key]
+                self._dispatch(key, items)
+            
+            text = future.result()
+            if text is _UNBATCHED:
+                return self.client._generate(prompt, max_tokens, temperature, max_retries)
+            return text
+        finally:
+            with self._lock:
+                self._active -= 1
+    
+    def _dispatch(self, key, batch):
+        max_tokens, temperature = key
+        prompts = [prompt for prompt, _ in batch]
+        if len(prompts) == 1:
+            results = [_UNBATCHED]
+        else:
+            # Single attempt (no adapter retries): on failure every caller retries on its own
+            results = self.client._generate_batch(prompts, max_tokens, temperature)
+            with self._lock:
+                if results is None:
+                    self._failures += 1
+                    if self.enabled and self._failures >= self.max_failures:
+                        app.logger.warning("Batched inference keeps failing, sending requests individually")
+                        self.enabled = False
+                else:
+                    self._failures = 0
+            if results is None:
+                results = [_UNBATCHED] * len(prompts)
+            else:
+                results = [_UNBATCHED if text is None else text for text in results]
+        
+        for (_, future), text in zip(batch, results):
+            future.set_result(text)
+
+def _generated_text(item):
+    """Pull the generated text out of one text-generation result"""
+    if isinstance(item, list):
+        item = item[0] if item else None
+    if isinstance(item, dict):
+        return item.get('generated_text', '').strip()
+    return None
+
+def is_model_unserved(error):
+    """Whether an inference error means the model itself can't be served (so retrying it is pointless)"""
+    if isinstance(error, HfHubHTTPError):
+        return error.response is not None and error.response.status_code == 404
+    # InferenceClient raises ValueError when no provider serves the model for text generation
+    return isinstance(error, ValueError) and ('provider' in str(error) or 'not supported' in str(error))
+
+# Improved HF client with error handling, built on huggingface_hub.InferenceClient
 class SafeInferenceClient:
     def __init__(self, model_name, token):
-        self.model_name = model_name
         self.token = token
-        self.headers = {"Authorization": f"Bearer {token}"}
-        self.api_url = f"https://api-inference.huggingface.co/models/{model_name}"
+        self.batch_session = batch_http_session
+        self._switch_lock = threading.Lock()
+        self._set_model(model_name)
+        self.batcher = None
+        if HF_BATCH_WINDOW_MS > 0 and get_provider_helper is not None:
+            self.batcher = InferenceBatcher(self, HF_MAX_BATCH, HF_BATCH_WINDOW_MS)
+    
+    def _set_model(self, model_name):
+        self.model_name = model_name
+        # huggingface_hub sends requests with httpx2, which takes the same (connect, read) split
+        self._client = InferenceClient(
+            model=model_name,
+            token=self.token,
+            timeout=httpx2.Timeout(REQUEST_TIMEOUT[1], connect=REQUEST_TIMEOUT[0])
+        )
+    
+    def switch_to_working_model(self):
+        """Point the client at the first model from AVAILABLE_MODELS that responds"""
+        with self._switch_lock:
+            model_name = get_working_model()
+            if model_name != self.model_name:
+                app.logger.warning(f"Model {self.model_name} unavailable, switching to {model_name}")
+                self._set_model(model_name)
+    
+    def generate_text(self, prompt, max_tokens=500, temperature=0.7, max_retries=3, validate=None):
+        """Generate text, reusing cached replies for identical requests
+        
+        Only replies that pass `validate` (if given) are cached, so a reply the
+        caller can't use is never served again from the cache.
+        """
+        cache_key = hashlib.blake2b(
+            f"{self.model_name}\0{max_tokens}\0{temperature}\0{prompt}".encode(),
+            digest_size=16
+        ).hexdigest()
+        variants = response_cache.get(cache_key) or []
+        if len(variants) >= (RESPONSE_VARIANTS if temperature > 0 else 1):
+            return random.choice(variants)
+        
+        if self.batcher:
+            text = self.batcher.submit(prompt, max_tokens, temperature, max_retries)
+        else:
+            text = self._generate(prompt, max_tokens, temperature, max_retries)
+        if text is None:
+            return "I'm having trouble generating a response. Please try again."
+        if text and (validate is None or validate(text)):
+            response_cache.set(cache_key, variants + [text])
+        return text
     
-    def generate_text(self, prompt, max_tokens=500, temperature=0.7, max_retries=3):
-        """Generate text with robust error handling"""
+    def _generate(self, prompt, max_tokens, temperature, max_retries):
+        """Call the inference API with robust error handling; None if every attempt failed"""
+        status_code = None
         for attempt in range(max_retries):
+            wait_hint = None
             try:
-                payload = {
-                    "inputs": prompt,
-                    "parameters": {
-                        "max_new_tokens": max_tokens,
-                        "temperature": temperature,
-                        "do_sample": True,
-                        "return_full_text": False
-                    }
-                }
-                
-                response = requests.post(
-                    self.api_url,
-                    headers=self.headers,
-                    json=payload,
-                    timeout=30
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if isinstance(result, list) and len(result) > 0:
-                        return result[0].get('generated_text', '').strip()
-                    elif isinstance(result, dict):
-                        return result.get('generated_text', '').strip()
-                elif response.status_code == 503:
-                    # Model is loading
-                    app.logger.info(f"Model loading, waiting... (attempt {attempt + 1})")
-                    time.sleep(10)
+                with inference_slots:
+                    return self._client.text_generation(
+                        prompt,
+                        max_new_tokens=max_tokens,
+                        temperature=temperature,
+                        do_sample=True,
+                        return_full_text=False
+                    ).strip()
+            except (HfHubHTTPError, ValueError) as e:
+                if is_model_unserved(e):
+                    # Configured model isn't served; retry straight away on one that is
+                    self.switch_to_working_model()
                     continue
+                response = getattr(e, 'response', None)
+                status_code = response.status_code if response is not None else None
+                if status_code == 503:
+                    # Model is loading; the API tells us roughly how long it needs
+                    app.logger.info(f"Model loading, waiting... (attempt {attempt + 1})")
+                    try:
+                        wait_hint = response.json().get('estimated_time')
+                    except (ValueError, AttributeError):
+                        pass
+                elif status_code == 429:
+                    app.logger.warning(f"Rate limited, backing off... (attempt {attempt + 1})")
+                    wait_hint = response.headers.get('Retry-After')
                 else:
-                    app.logger.error(f"API error: {response.status_code} - {response.text}")
-                    
+                    app.logger.error(f"API error: {str(e)}")
             except Exception as e:
                 app.logger.error(f"Request failed (attempt {attempt + 1}): {str(e)}")
-                if attempt < max_retries - 1:
-                    time.sleep(5)
+            
+            if attempt < max_retries - 1:
+                time.sleep(backoff_delay(attempt, wait_hint))
+        
+        if status_code == 503:
+            # Still loading after every retry; use a model that responds from now on
+            self.switch_to_working_model()
+        
+        return None
+    
+    def _generate_batch(self, prompts, max_tokens, temperature):
+        """Send several prompts as one list-of-inputs request; None if it fails
         
-        return "I'm having trouble generating a response. Please try again."
+        InferenceClient has no batch API, so this builds the request with the same
+        provider routing InferenceClient uses and posts it through a pooled session.
+        """
+        try:
+            helper = get_provider_helper(self._client.provider, task="text-generation", model=self.model_name)
+            # Only HF Inference accepts a list of inputs; other providers get single calls
+            if helper.provider != "hf-inference":
+                return None
+            request_parameters = helper.prepare_request(
+                inputs=prompts,
+                parameters={
+                    "max_new_tokens": max_tokens,
+                    "temperature": temperature,
+                    "do_sample": True,
+                    "return_full_text": False
+                },
+                headers={},
+                model=self.model_name,
+                api_key=self.token
+            )
+            with inference_slots:
+                response = self.batch_session.post(
+                    request_parameters.url,
+                    headers=request_parameters.headers,
+                    json=request_parameters.json,
+                    timeout=REQUEST_TIMEOUT
+                )
+            if response.status_code == 200:
+                result = response.json()
+                if isinstance(result, list) and len(result) == len(prompts):
+                    return [_generated_text(item) for item in result]
+            app.logger.warning(f"Batched request failed: {response.status_code}")
+        except Exception as e:
+            app.logger.warning(f"Batched request failed: {str(e)}")
+        return None
+    
+    def stream_text(self, prompt, max_tokens=500, temperature=0.7):
+        """Yield text as the model generates it, falling back to one full reply if streaming fails"""
+        streamed = False
+        try:
+            with inference_slots:
+                for output in self._client.text_generation(
+                    prompt,
+                    max_new_tokens=max_tokens,
+                    temperature=temperature,
+                    do_sample=True,
+                    return_full_text=False,
+                    details=True,
+                    stream=True
+                ):
+                    if output.token.text and not output.token.special:
+                        streamed = True
+                        yield output.token.text
+            if streamed:
+                return
+        except Exception as e:
+            app.logger.error(f"Streaming request failed: {str(e)}")
+            if streamed:
+                return
+        
+        yield self.generate_text(prompt, max_tokens=max_tokens, temperature=temperature)
+    
+    def ping(self):
+        """Send a one-token request so the hosted model stays loaded"""
+        try:
+            self._client.text_generation("ping", max_new_tokens=1)
+        except Exception as e:
+            app.logger.warning(f"Keep-alive ping failed: {str(e)}")
 
 # Initialize clients
 hf_client = SafeInferenceClient(WORKING_MODEL, HF_TOKEN)
 
-# In-memory storage for lessons and sessions
-lessons = {}
-sessions = {}
+# Serverless models are unloaded when idle; ping periodically so real users skip the cold start
+HF_KEEPALIVE_SECONDS = int(os.getenv('HF_KEEPALIVE_SECONDS', '240'))
+
+def keep_model_warm():
+    while True:
+        hf_client.ping()
+        time.sleep(HF_KEEPALIVE_SECONDS)
+
+if HF_KEEPALIVE_SECONDS > 0:
+    threading.Thread(target=keep_model_warm, name='hf-keepalive', daemon=True).start()
+
+class RedisStore:
+    """Dict-like store that keeps JSON values in Redis so all workers share state
+    
+    Every write resets the key's expiry, so `ttl` acts as an inactivity timeout.
+    """
+    def __init__(self, client, prefix, ttl=None, load=None):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        # Rebuilds non-JSON types (e.g. deques) on values read back from Redis
+        self.load = load
+    
+    def _key(self, key):
+        return f"{self.prefix}:{key}"
+    
+    def __contains__(self, key):
+        return self.client.exists(self._key(key)) > 0
+    
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+    
+    def __setitem__(self, key, value):
+        self.set(key, value)
+    
+    def set(self, key, value, pipe=None):
+        # Deques are stored as plain lists
+        (pipe or self.client).set(self._key(key), orjson.dumps(value, default=list), ex=self.ttl)
+    
+    def get(self, key, default=None):
+        raw = self.client.get(self._key(key))
+        if raw is None:
+            return default
+        value = orjson.loads(raw)
+        return self.load(value) if self.load else value
+    
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self.client.delete(self._key(key))
+        return value
+
+class MemoryConversations:
+    """Per-session chat transcripts kept in process memory, dropped after `ttl` idle seconds"""
+    def __init__(self, maxlen, maxsize, ttl=None):
+        self.maxlen = maxlen
+        self._logs = TTLCache(maxsize=maxsize, ttl=ttl)
+    
+    def append(self, session_id, *turns):
+        log = self._logs.get(session_id)
+        if log is None:
+            log = deque(maxlen=self.maxlen)
+        log.extend(turns)
+        # Writing it back restarts the idle timeout
+        self._logs.set(session_id, log)
+    
+    def get(self, session_id):
+        return list(self._logs.get(session_id, ()))
+    
+    def pop(self, session_id):
+        self._logs.pop(session_id)
+
+class RedisConversations:
+    """Per-session chat transcripts as Redis lists, so a turn is an append rather than a rewrite"""
+    def __init__(self, client, prefix, maxlen, ttl=None):
+        self.client = client
+        self.prefix = prefix
+        self.maxlen = maxlen
+        self.ttl = ttl
+    
+    def _key(self, session_id):
+        return f"{self.prefix}:{session_id}"
+    
+    def append(self, session_id, *turns, pipe=None):
+        key = self._key(session_id)
+        own_pipe = pipe is None
+        if own_pipe:
+            pipe = self.client.pipeline()
+        pipe.rpush(key, *(orjson.dumps(turn) for turn in turns))
+        pipe.ltrim(key, -self.maxlen, -1)
+        if self.ttl:
+            pipe.expire(key, self.ttl)
+        if own_pipe:
+            pipe.execute()
+    
+    def get(self, session_id):
+        return [tuple(orjson.loads(turn)) for turn in self.client.lrange(self._key(session_id), 0, -1)]
+    
+    def pop(self, session_id):
+        self.client.delete(self._key(session_id))
+
+# Storage for lessons, sessions, their conversations and in-progress lesson plan
+# drafts: Redis when configured, otherwise in-memory
+REDIS_URL = os.getenv('REDIS_URL')
+LESSON_TTL_SECONDS = 30 * 86400
+SESSION_TTL_SECONDS = 86400
+DRAFT_TTL_SECONDS = 86400
+
+# Turns kept for display; older ones are dropped so long sessions stay bounded in memory
+MAX_CONVERSATION_TURNS = 200
+
+# Most student sessions one process keeps without Redis; the least recently active go first
+MAX_MEMORY_SESSIONS = 10000
+
+# Number of recent conversation lines sent to the model with each turn
+CONTEXT_WINDOW = 5
+
+def load_session(session_data):
+    """Turn a session read back from Redis into its in-memory form"""
+    session_data['context'] = deque(session_data['context'], maxlen=CONTEXT_WINDOW)
+    return session_data
+
+if REDIS_URL:
+    import redis
+    redis_client = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(REDIS_URL, max_connections=50))
+    lessons = RedisStore(redis_client, 'tutorbot:lesson', ttl=LESSON_TTL_SECONDS)
+    sessions = RedisStore(redis_client, 'tutorbot:session', ttl=SESSION_TTL_SECONDS, load=load_session)
+    conversations = RedisConversations(redis_client, 'tutorbot:conversation', MAX_CONVERSATION_TURNS, ttl=SESSION_TTL_SECONDS)
+    drafts = RedisStore(redis_client, 'tutorbot:draft', ttl=DRAFT_TTL_SECONDS)
+else:
+    lessons = {}
+    # Abandoned sessions expire like they do in Redis: every chat turn rewrites
+    # the session and appends to its transcript, restarting the idle timeout
+    sessions = TTLCache(maxsize=MAX_MEMORY_SESSIONS, ttl=SESSION_TTL_SECONDS)
+    conversations = MemoryConversations(MAX_CONVERSATION_TURNS, MAX_MEMORY_SESSIONS, ttl=SESSION_TTL_SECONDS)
+    # Teachers who never finalize would otherwise leave their drafts here forever
+    drafts = TTLCache(maxsize=1024, ttl=DRAFT_TTL_SECONDS)
+
+def save_turn(session_id, session_data, *turns):
+    """Store the updated session and its new conversation turns (one round trip with Redis)"""
+    if REDIS_URL:
+        pipe = redis_client.pipeline()
+        sessions.set(session_id, session_data, pipe=pipe)
+        conversations.append(session_id, *turns, pipe=pipe)
+        pipe.execute()
+    else:
+        sessions[session_id] = session_data
+        conversations.append(session_id, *turns)
+
+# How long a Redis lock outlives a worker that died holding it. Held locks are
+# renewed in the background, so a slow turn (retries, backoff, a slow SSE
+# client) never loses its lock to this timeout.
+LOCK_TIMEOUT_SECONDS = 30
 
-# Improved prompts for better text generation
-TEACHER_PROMPT = """Create a lesson plan for the given topic. Format your response as JSON with these sections:
-- objectives: List 3-5 learning goals
-- workflow: Step-by-step teaching process
-- assessment: 5 questions with answers
-- practice_quiz: Practice questions with hints
+class RenewingRedisLock:
+    """Redis lock whose expiry is extended for as long as it is held"""
+    def __init__(self, client, name, timeout):
+        # Not thread-local: the renewal thread has to act on the token acquired here
+        self.lock = client.lock(name, timeout=timeout, thread_local=False)
+        self.timeout = timeout
+        self._released = threading.Event()
+    
+    def __enter__(self):
+        self.lock.acquire()
+        self._released.clear()
+        threading.Thread(target=self._renew, name='lock-renewal', daemon=True).start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._released.set()
+        try:
+            self.lock.release()
+        except redis.exceptions.LockNotOwnedError:
+            # The work is done; don't turn it into an error because the lock lapsed
+            app.logger.warning(f"Lock {self.lock.name} expired before it was released")
+    
+    def _renew(self):
+        while not self._released.wait(self.timeout / 3):
+            try:
+                self.lock.reacquire()
+            except redis.exceptions.LockError:
+                app.logger.warning(f"Lost lock {self.lock.name} while holding it")
+                return
+
+# Per-record locks so overlapping requests for one student session (or lesson) run one at a time
+_record_locks = weakref.WeakValueDictionary()
+_record_locks_guard = threading.Lock()
+
+def record_lock(name):
+    """Lock serializing updates to one stored record (shared across workers with Redis)"""
+    if REDIS_URL:
+        return RenewingRedisLock(redis_client, f"tutorbot:lock:{name}", LOCK_TIMEOUT_SECONDS)
+    with _record_locks_guard:
+        lock = _record_locks.get(name)
+        if lock is None:
+            lock = threading.Lock()
+            _record_locks[name] = lock
+        return lock
 
-Topic: """
+def session_lock(session_id):
+    """Lock serializing updates to one student session"""
+    return record_lock(session_id)
+
+def lesson_lock(token):
+    """Lock serializing read-modify-writes of one lesson, e.g. students finishing at the same time"""
+    return record_lock(f"lesson:{token}")
+
+# Generated lesson plans keyed by a hash of the topic, so repeat topics skip the API
+lesson_cache = TTLCache(maxsize=1024, ttl=86400)
+
+# Modified plans keyed by a hash of (feedback, current plan), so repeated edits skip the API
+modification_cache = TTLCache(maxsize=512)
+
+# Improved prompts for better text generation. Each lesson plan section has its own
+# prompt so the sections can be generated concurrently and assembled locally.
+SECTION_PROMPTS = {
+    'objectives': "List 3-5 learning goals for a lesson on the topic below. Respond with a JSON array of strings.\n\nTopic: ",
+    'workflow': "Describe the step-by-step teaching process for a lesson on the topic below. Respond with a JSON array of strings.\n\nTopic: ",
+    'assessment': 'Write 5 assessment questions with answers for a lesson on the topic below. Respond with a JSON array of objects with "question" and "answer" keys.\n\nTopic: ',
+    'practice_quiz': 'Write practice questions with hints for a lesson on the topic below. Respond with a JSON array of objects with "question" and "hint" keys.\n\nTopic: '
+}
+
+MODIFY_TEMPLATE = "Modify this lesson plan based on feedback: '{feedback}'\n\nCurrent plan: {plan}\n\nProvide the modified plan in JSON format:"
 
 STUDENT_PROMPT = """You are a helpful AI tutor. Your role is to:
 1. Guide students through lessons step by step
@@ -146,23 +721,43 @@ STUDENT_PROMPT = """You are a helpful AI tutor. Your role is to:
 
 Current lesson context: """
 
-def generate_lesson_plan(topic):
-    """Generate a lesson plan using HF model"""
-    prompt = TEACHER_PROMPT + topic
-    
+# Full tutor prompt, built once; each turn only fills in the placeholders
+TUTOR_TEMPLATE = STUDENT_PROMPT + "\n\nLesson objectives: {objectives}\n\nConversation:\n{context}\n\nTutor:"
+
+LESSON_PLAN_SECTIONS = ('objectives', 'workflow', 'assessment', 'practice_quiz')
+
+# Lesson plans are structured output, so sample them conservatively
+PLAN_TEMPERATURE = 0.4
+
+def is_valid_section(section, items):
+    """Check that a lesson plan section is a non-empty list (of strings, for objectives)"""
+    if not isinstance(items, list) or not items:
+        return False
+    return section != 'objectives' or all(isinstance(item, str) for item in items)
+
+def is_valid_lesson_plan(plan):
+    """Check that a parsed model reply has every lesson plan section as a non-empty list"""
+    return isinstance(plan, dict) and all(is_valid_section(section, plan.get(section)) for section in LESSON_PLAN_SECTIONS)
+
+_json_decoder = json.JSONDecoder()
+
+def extract_json(text, opener='{', closer='}'):
+    """Parse the first JSON value starting with `opener` out of free-form model output"""
+    json_start = text.find(opener)
+    if json_start == -1:
+        raise ValueError("No JSON found in model output")
     try:
-        response = hf_client.generate_text(prompt, max_tokens=800, temperature=0.7)
-        
-        # Try to extract JSON from response
-        if '{' in response and '}' in response:
-            json_start = response.find('{')
-            json_end = response.rfind('}') + 1
-            json_str = response[json_start:json_end]
-            return json.loads(json_str)
-    except Exception as e:
-        app.logger.error(f"Failed to generate lesson plan: {str(e)}")
-    
-    # Fallback lesson plan
+        # Stops at the end of the first complete value, so trailing prose doesn't matter
+        return _json_decoder.raw_decode(text, json_start)[0]
+    except json.JSONDecodeError:
+        # Fall back once to everything between the outermost delimiters
+        json_end = text.rfind(closer) + 1
+        if json_end <= json_start:
+            raise
+        return orjson.loads(text[json_start:json_end])
+
+def fallback_lesson_plan(topic):
+    """Generic lesson plan used for any section the model fails to produce"""
     return {
         "objectives": [
             f"Understand the basic concepts of {topic}",
@@ -187,22 +782,149 @@ def generate_lesson_plan(topic):
         ]
     }
 
-def generate_tutor_response(conversation_history, lesson_data, current_step):
-    """Generate tutor response using HF model"""
-    # Create context from conversation
-    context = "\n".join([f"{role.title()}: {msg}" for role, msg in conversation_history[-5:]])  # Last 5 messages
+# Runs independent model calls (e.g. lesson plan sections) side by side
+llm_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='llm')
+
+def parse_section(section, response):
+    """The lesson plan section in a model reply; None if it is missing or invalid"""
+    try:
+        items = extract_json(response, '[', ']')
+    except ValueError:
+        return None
+    return items if is_valid_section(section, items) else None
+
+def parse_lesson_plan(response):
+    """The full lesson plan in a model reply; None if it is missing or invalid"""
+    try:
+        plan = extract_json(response)
+    except ValueError:
+        return None
+    return plan if is_valid_lesson_plan(plan) else None
+
+def generate_section(section, topic):
+    """Generate one lesson plan section; None if the model's reply is unusable"""
+    try:
+        response = hf_client.generate_text(
+            SECTION_PROMPTS[section] + topic,
+            max_tokens=300,
+            temperature=PLAN_TEMPERATURE,
+            validate=lambda text: parse_section(section, text) is not None
+        )
+        items = parse_section(section, response)
+        if items is not None:
+            return items
+        app.logger.warning(f"Invalid '{section}' section for '{topic}'")
+    except Exception as e:
+        app.logger.error(f"Failed to generate '{section}' section: {str(e)}")
+    return None
+
+def generate_lesson_plan(topic):
+    """Generate a lesson plan using HF model, one concurrent call per section"""
+    cache_key = hashlib.sha256(topic.encode()).hexdigest()
     
-    prompt = f"{STUDENT_PROMPT}\n\nLesson objectives: {', '.join(lesson_data['objectives'])}\n\nConversation:\n{context}\n\nTutor:"
+    cached_plan = lesson_cache.get(cache_key)
+    if cached_plan is not None:
+        return copy.deepcopy(cached_plan)
     
-    response = hf_client.generate_text(prompt, max_tokens=200, temperature=0.8)
+    sections = list(llm_executor.map(lambda section: generate_section(section, topic), LESSON_PLAN_SECTIONS))
     
-    if not response or len(response.strip()) < 10:
-        return "That's interesting! Can you tell me more about what you're thinking? I'm here to help you learn."
+    # Fill any failed section from the fallback lesson plan
+    fallback = fallback_lesson_plan(topic)
+    lesson_plan = {
+        section: items if items is not None else fallback[section]
+        for section, items in zip(LESSON_PLAN_SECTIONS, sections)
+    }
     
-    return response
+    # Only fully generated plans are worth reusing
+    if all(items is not None for items in sections):
+        lesson_cache.set(cache_key, lesson_plan)
+        return copy.deepcopy(lesson_plan)
+    return lesson_plan
+
+def add_to_context(session_data, role, message):
+    """Keep the formatted model context up to date with a new chat turn"""
+    session_data['context'].append(f"{role.title()}: {message}")
+
+FALLBACK_TUTOR_REPLY = "That's interesting! Can you tell me more about what you're thinking? I'm here to help you learn."
+
+def build_tutor_prompt(context_lines, objectives_text):
+    """Fill the tutor template with the lesson objectives and recent conversation"""
+    # context_lines is a rolling window, so this only ever joins CONTEXT_WINDOW lines
+    return TUTOR_TEMPLATE.format_map({
+        'objectives': objectives_text,
+        'context': "\n".join(context_lines)
+    })
+
+def clean_tutor_response(response):
+    """Replace empty or too-short model output with a generic prompt to keep going"""
+    if not response or len(response.strip()) < 10:
+        return FALLBACK_TUTOR_REPLY
+    return response.strip()
+
+def generate_tutor_response(context_lines, objectives_text, current_step):
+    """Generate tutor response using HF model"""
+    prompt = build_tutor_prompt(context_lines, objectives_text)
+    response = hf_client.generate_text(prompt, max_tokens=200, temperature=0.8)
+    return clean_tutor_response(response)
+
+def repeated_reply(session_data, nonce):
+    """The recorded reply if this submission's nonce was already answered, else None"""
+    if nonce and nonce == session_data.get('last_nonce'):
+        return session_data['last_reply']
+    return None
+
+def record_turn(session_id, session_data, user_input, tutor_response, nonce):
+    """Store a finished chat turn; the student's message is already in the context"""
+    add_to_context(session_data, "tutor", tutor_response)
+    session_data['last_nonce'] = nonce
+    session_data['last_reply'] = tutor_response
+    # The session value only holds the small context window, so
+    # rewriting it is cheap; the transcript itself is only appended to
+    save_turn(session_id, session_data, ("student", user_input), ("tutor", tutor_response))
+
+def chat_turn(session_id, user_input, nonce):
+    """Record one student message and the tutor's reply, returning the reply"""
+    with session_lock(session_id):
+        # Re-read under the lock in case another request just updated it
+        session_data = sessions[session_id]
+        
+        # A double-clicked or retried submission: its reply is already recorded
+        reply = repeated_reply(session_data, nonce)
+        if reply is not None:
+            return reply
+        
+        add_to_context(session_data, "student", user_input)
+        
+        # Generate tutor response
+        tutor_response = generate_tutor_response(
+            session_data['context'], 
+            session_data['objectives_text'], 
+            session_data['current_step']
+        )
+        
+        record_turn(session_id, session_data, user_input, tutor_response, nonce)
+        return tutor_response
+
+def sse_event(data, event=None):
+    """Format one server-sent event with a JSON payload"""
+    frame = f"data: {orjson.dumps(data).decode()}\n\n"
+    return f"event: {event}\n{frame}" if event else frame
+
+def short_id():
+    """Random 128-bit id as 22 URL-safe characters"""
+    return secrets.token_urlsafe(16)
 
 # Routes
 
+@app.after_request
+def add_cache_headers(response):
+    """Let browsers reuse a polled analytics page for a minute"""
+    # Only analytics is safe to cache: a lesson plan draft changes right after
+    # a modify redirect, so caching it would show the teacher the old plan
+    if request.endpoint == 'analytics' and response.status_code == 200:
+        response.headers['Cache-Control'] = 'private, max-age=60'
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -211,45 +933,73 @@ def index():
 def teacher_interface():
     if request.method == 'POST':
         action = request.form.get('action')
+        # Lesson plan drafts live server-side; the cookie only carries the draft id
+        draft_id = session.get('draft_id')
         
         if action == 'create_topic':
             # Step 1: User enters topic
+            if draft_id:
+                drafts.pop(draft_id, None)
             session['topic'] = request.form['topic']
-            session['lesson_data'] = None
+            session['draft_id'] = short_id()
             return redirect(url_for('lesson_plan'))
         
         elif action == 'modify_lesson':
             # Step 2: Handle lesson modifications
             feedback = request.form.get('feedback', '').strip()
-            if feedback and session.get('lesson_data'):
-                # Modify lesson based on feedback
-                modify_prompt = f"Modify this lesson plan based on feedback: '{feedback}'\n\nCurrent plan: {json.dumps(session['lesson_data'])}\n\nProvide the modified plan in JSON format:"
+            lesson_data = drafts.get(draft_id) if draft_id else None
+            if feedback and lesson_data:
+                current_plan_json = orjson.dumps(lesson_data).decode()
+                cache_key = hashlib.sha256(f"{feedback}|{current_plan_json}".encode()).hexdigest()
+                cached_plan = modification_cache.get(cache_key)
                 
-                try:
-                    response = hf_client.generate_text(modify_prompt, max_tokens=800)
-                    if '{' in response and '}' in response:
-                        json_start = response.find('{')
-                        json_end = response.rfind('}') + 1
-                        json_str = response[json_start:json_end]
-                        session['lesson_data'] = json.loads(json_str)
-                except Exception as e:
-                    app.logger.error(f"Failed to modify lesson: {str(e)}")
+                if cached_plan is not None:
+                    drafts[draft_id] = copy.deepcopy(cached_plan)
+                else:
+                    # Modify lesson based on feedback
+                    modify_prompt = MODIFY_TEMPLATE.format_map({'feedback': feedback, 'plan': current_plan_json})
+                    
+                    try:
+                        response = hf_client.generate_text(
+                            modify_prompt,
+                            max_tokens=800,
+                            temperature=PLAN_TEMPERATURE,
+                            validate=lambda text: parse_lesson_plan(text) is not None
+                        )
+                        modified_plan = parse_lesson_plan(response)
+                        # Keep the current draft rather than replacing it with a broken plan
+                        if modified_plan is not None:
+                            modification_cache.set(cache_key, modified_plan)
+                            drafts[draft_id] = copy.deepcopy(modified_plan)
+                        else:
+                            app.logger.warning("Modified lesson plan is invalid, keeping current plan")
+                    except Exception as e:
+                        app.logger.error(f"Failed to modify lesson: {str(e)}")
             
             return redirect(url_for('lesson_plan'))
         
         elif action == 'finalize_lesson':
             # Step 3: Finalize and create access token
-            if session.get('lesson_data'):
-                token = str(uuid.uuid4())[:8]  # Shorter token for easier sharing
+            lesson_data = drafts.pop(draft_id, None) if draft_id else None
+            if lesson_data:
+                token = secrets.token_urlsafe(6)  # 8 characters for easier sharing
+                topic = session.get('topic', 'Unknown Topic')
+                # Joined once here instead of on every chat turn
+                objectives_text = ', '.join(lesson_data['objectives'])
                 lessons[token] = {
-                    'lesson_data': session['lesson_data'],
-                    'topic': session.get('topic', 'Unknown Topic'),
-                    'created_at': datetime.datetime.now(),
-                    'sessions': []
+                    'lesson_data': lesson_data,
+                    'objectives_text': objectives_text,
+                    'welcome_msg': f"Hello! I'm your AI tutor. Today we'll learn about {topic}. Let's start with the learning objectives: {objectives_text}. Are you ready to begin?",
+                    'topic': topic,
+                    'created_at': time.time(),
+                    'sessions': [],
+                    # Running totals so analytics doesn't rescan every session
+                    'rating_sum': 0.0,
+                    'rating_count': 0
                 }
                 
                 # Clear session data
-                session.pop('lesson_data', None)
+                session.pop('draft_id', None)
                 session.pop('topic', None)
                 
                 return render_template('teacher.html', 
@@ -264,37 +1014,42 @@ def teacher_interface():
 
 @app.route('/lesson_plan')
 def lesson_plan():
-    if 'topic' not in session:
+    draft_id = session.get('draft_id')
+    if 'topic' not in session or not draft_id:
         return redirect(url_for('teacher_interface'))
     
     # Generate initial lesson plan if not exists
-    if not session.get('lesson_data'):
+    lesson_data = drafts.get(draft_id)
+    if not lesson_data:
         app.logger.info(f"Generating lesson plan for: {session['topic']}")
-        session['lesson_data'] = generate_lesson_plan(session['topic'])
+        lesson_data = generate_lesson_plan(session['topic'])
+        drafts[draft_id] = lesson_data
     
     return render_template('lesson_plan.html', 
                           topic=session['topic'],
-                          lesson_data=session['lesson_data'])
+                          lesson_data=lesson_data)
 
 @app.route('/student', methods=['GET', 'POST'])
 def student_interface():
     if request.method == 'POST':
         token = request.form['token'].strip()
-        if token in lessons:
-            session_id = str(uuid.uuid4())
-            sessions[session_id] = {
+        lesson = lessons.get(token)
+        if lesson is not None:
+            session_id = short_id()
+            session_data = {
                 'token': token,
-                'start_time': datetime.datetime.now(),
+                # Copied from the lesson so chat turns never need to load the lesson itself
+                'topic': lesson.get('topic', 'Unknown Topic'),
+                'objectives_text': lesson['objectives_text'],
+                'start_time': time.time(),
                 'current_step': 0,
-                'conversation': [],
+                'context': deque(maxlen=CONTEXT_WINDOW),
                 'quiz_responses': [],
                 'assessment_score': None,
                 'rating': None
             }
-            
-            lesson_topic = lessons[token].get('topic', 'this topic')
-            welcome_msg = f"Hello! I'm your AI tutor. Today we'll learn about {lesson_topic}. Let's start with the learning objectives: {', '.join(lessons[token]['lesson_data']['objectives'])}. Are you ready to begin?"
-            sessions[session_id]['conversation'].append(("tutor", welcome_msg))
+            add_to_context(session_data, "tutor", lesson['welcome_msg'])
+            save_turn(session_id, session_data, ("tutor", lesson['welcome_msg']))
             session['session_id'] = session_id
             return redirect(url_for('tutor_chat'))
         else:
@@ -304,51 +1059,115 @@ def student_interface():
 @app.route('/chat', methods=['GET', 'POST'])
 def tutor_chat():
     session_id = session.get('session_id')
-    if not session_id or session_id not in sessions:
+    session_data = sessions.get(session_id) if session_id else None
+    if session_data is None:
         return redirect(url_for('student_interface'))
     
-    session_data = sessions[session_id]
-    token = session_data['token']
-    lesson = lessons[token]['lesson_data']
-    
     if request.method == 'POST':
-        user_input = request.form['message']
-        session_data['conversation'].append(("student", user_input))
-        
-        # Generate tutor response
-        tutor_response = generate_tutor_response(
-            session_data['conversation'], 
-            lesson, 
-            session_data['current_step']
-        )
-        
-        session_data['conversation'].append(("tutor", tutor_response))
-        sessions[session_id] = session_data
+        chat_turn(session_id, request.form['message'], request.form.get('nonce'))
     
     return render_template('chat.html', 
-                          conversation=session_data['conversation'],
-                          lesson_topic=lessons[token].get('topic', 'Unknown Topic'))
+                          conversation=conversations.get(session_id),
+                          lesson_topic=session_data['topic'],
+                          nonce=short_id())
 
-@app.route('/complete', methods=['POST'])
-def complete_session():
+@app.route('/api/chat', methods=['POST'])
+def api_chat():
+    """Answer one chat message with just the new tutor turn as JSON"""
     session_id = session.get('session_id')
     if not session_id or session_id not in sessions:
-        return redirect(url_for('index'))
+        return jsonify({'error': 'Session not found'}), 404
     
-    session_data = sessions[session_id]
-    session_data['rating'] = request.form.get('rating', 'Not rated')
-    session_data['end_time'] = datetime.datetime.now()
+    data = request.get_json(silent=True)
+    if data is None:
+        data = request.form
+    user_input = data.get('message') if isinstance(data, dict) else None
+    if not isinstance(user_input, str) or not user_input.strip():
+        return jsonify({'error': 'Message is required'}), 400
+    nonce = data.get('nonce')
+    
+    tutor_response = chat_turn(session_id, user_input.strip(), nonce if isinstance(nonce, str) else None)
+    return jsonify({'reply': tutor_response, 'nonce': short_id()})
+
+@app.route('/chat/stream', methods=['POST'])
+def tutor_chat_stream():
+    """Stream the tutor's reply as server-sent events so the first words show up right away"""
+    session_id = session.get('session_id')
+    if not session_id or session_id not in sessions:
+        return "Session not found", 404
     
-    duration_minutes = (session_data['end_time'] - session_data['start_time']).seconds // 60
+    user_input = request.form['message']
+    nonce = request.form.get('nonce')
     
-    lessons[session_data['token']]['sessions'].append({
-        'session_id': session_id,
-        'start_time': session_data['start_time'],
-        'end_time': session_data['end_time'],
-        'duration': duration_minutes,
-        'rating': session_data['rating'],
-        'score': session_data.get('assessment_score', 'N/A')
-    })
+    def generate():
+        with session_lock(session_id):
+            session_data = sessions[session_id]
+            
+            # A retried submission: resend the reply that was already recorded
+            reply = repeated_reply(session_data, nonce)
+            if reply is not None:
+                yield sse_event({'reply': reply, 'nonce': short_id()}, event='done')
+                return
+            
+            add_to_context(session_data, "student", user_input)
+            prompt = build_tutor_prompt(session_data['context'], session_data['objectives_text'])
+            
+            chunks = []
+            for text in hf_client.stream_text(prompt, max_tokens=200, temperature=0.8):
+                chunks.append(text)
+                yield sse_event(text)
+            
+            # Only the complete reply is recorded in the conversation
+            tutor_response = clean_tutor_response(''.join(chunks))
+            record_turn(session_id, session_data, user_input, tutor_response, nonce)
+            
+            yield sse_event({'reply': tutor_response, 'nonce': short_id()}, event='done')
+    
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/complete', methods=['POST'])
+def complete_session():
+    session_id = session.get('session_id')
+    if not session_id:
+        return redirect(url_for('index'))
+    
+    # Under the session lock so an in-flight chat turn can't write the
+    # session back after it has been removed below
+    with session_lock(session_id):
+        session_data = sessions.get(session_id)
+        if session_data is None:
+            session.pop('session_id', None)
+            return redirect(url_for('index'))
+        
+        session_data['rating'] = request.form.get('rating', 'Not rated')
+        session_data['end_time'] = time.time()
+        duration_minutes = int((session_data['end_time'] - session_data['start_time']) // 60)
+        
+        # With Redis the lesson is read, updated and written back whole, so another
+        # student finishing the same lesson must not interleave
+        with lesson_lock(session_data['token']):
+            lesson = lessons.get(session_data['token'])
+            if lesson is None:
+                # The lesson expired while the student was chatting
+                return "Lesson not found", 404
+            lesson['sessions'].append({
+                'session_id': session_id,
+                'start_time': session_data['start_time'],
+                'end_time': session_data['end_time'],
+                'duration': duration_minutes,
+                'rating': session_data['rating'],
+                'score': session_data.get('assessment_score', 'N/A')
+            })
+            if session_data['rating'].isdigit():
+                lesson['rating_sum'] = lesson.get('rating_sum', 0.0) + float(session_data['rating'])
+                lesson['rating_count'] = lesson.get('rating_count', 0) + 1
+            lessons[session_data['token']] = lesson
+        
+        # The lesson keeps the summary; the full conversation is no longer needed
+        sessions.pop(session_id, None)
+        conversations.pop(session_id)
     
     session.pop('session_id', None)
     
@@ -359,28 +1178,26 @@ def complete_session():
 
 @app.route('/analytics/<token>')
 def analytics(token):
-    if token not in lessons:
+    lesson_data = lessons.get(token)
+    if lesson_data is None:
         return "Invalid token", 404
     
-    lesson_data = lessons[token]
-    analytics_data = []
-    
-    for sess in lesson_data['sessions']:
-        analytics_data.append({
-            'session_id': sess['session_id'][:8] + "...",
-            'date': sess['start_time'].strftime("%Y-%m-%d %H:%M"),
-            'duration': f"{sess['duration']} mins",
-            'rating': sess['rating'],
-            'score': sess['score']
-        })
+    # Rows are formatted lazily as the template iterates over them
+    analytics_data = ({
+        'session_id': sess['session_id'][:8] + "...",
+        'date': datetime.datetime.fromtimestamp(sess['start_time']).strftime("%Y-%m-%d %H:%M"),
+        'duration': f"{sess['duration']} mins",
+        'rating': sess['rating'],
+        'score': sess['score']
+    } for sess in lesson_data['sessions'])
     
-    avg_rating = sum([float(s.get('rating', 0)) for s in lesson_data['sessions'] if s.get('rating', '0').isdigit()]) / max(len(lesson_data['sessions']), 1)
+    avg_rating = lesson_data.get('rating_sum', 0.0) / max(lesson_data.get('rating_count', 0), 1)
     
     return render_template('analytics.html', 
                           token=token,
                           topic=lesson_data.get('topic', 'Unknown Topic'),
                           sessions=analytics_data,
-                          total_sessions=len(analytics_data),
+                          total_sessions=len(lesson_data['sessions']),
                           avg_rating=round(avg_rating, 1))
 
 if __name__ == '__main__':
@@ -0,0 +1,13 @@
+# gunicorn.conf.py
+import os
+
+# Tutor and lesson-plan requests spend almost all of their time waiting on the
+# inference API, so serve them from a pool of threads instead of letting one
+# slow LLM call block the whole worker.
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))  # raise only with REDIS_URL set, or state is per-process
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+
+# Model loading on the inference API can take well over the 30s default
+timeout = 120
@@ -0,0 +1,211 @@
+# tests/test_concurrency.py
+# Checks for the Redis-backed storage, locks and inference batching, run against fakeredis
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+import jinja2
+import redis
+
+os.environ.update(
+    HF_TOKEN='test-token',
+    FLASK_SECRET_KEY='test-secret',
+    REDIS_URL='redis://localhost:6379/0',
+    HF_KEEPALIVE_SECONDS='0'
+)
+
+# Point the app's Redis connection pool at an in-process fake server
+server = fakeredis.FakeServer()
+redis.BlockingConnectionPool.from_url = classmethod(
+    lambda cls, url, **kwargs: fakeredis.FakeRedis(server=server).connection_pool
+)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as tutorbot
+
+# completion.html isn't part of the repo's templates
+tutorbot.app.jinja_loader = jinja2.ChoiceLoader([
+    tutorbot.app.jinja_loader,
+    jinja2.DictLoader({'completion.html': 'done'})
+])
+
+@pytest.fixture(autouse=True)
+def clean_redis():
+    tutorbot.redis_client.flushall()
+    yield
+
+def make_lesson(token):
+    tutorbot.lessons[token] = {
+        'lesson_data': {},
+        'objectives_text': 'Learn things',
+        'welcome_msg': 'Hello!',
+        'topic': 'Cells',
+        'created_at': time.time(),
+        'sessions': [],
+        'rating_sum': 0.0,
+        'rating_count': 0
+    }
+
+def test_lock_is_renewed_while_held(monkeypatch):
+    monkeypatch.setattr(tutorbot, 'LOCK_TIMEOUT_SECONDS', 0.6)
+    with tutorbot.session_lock('s1') as held:
+        time.sleep(1.5)
+        assert held.lock.owned()
+    assert not tutorbot.redis_client.exists('tutorbot:lock:s1')
+
+def test_lapsed_lock_release_does_not_raise():
+    with tutorbot.session_lock('s2'):
+        tutorbot.redis_client.delete('tutorbot:lock:s2')
+
+def test_lock_excludes_other_holders():
+    inside = []
+    overlaps = []
+
+    def hold():
+        with tutorbot.session_lock('s3'):
+            inside.append(1)
+            if len(inside) > 1:
+                overlaps.append(1)
+            time.sleep(0.05)
+            inside.pop()
+
+    threads = [threading.Thread(target=hold) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not overlaps
+
+def test_session_round_trips_as_json():
+    session_data = {
+        'token': 'T',
+        'context': tutorbot.deque(['Tutor: Hello!'], maxlen=tutorbot.CONTEXT_WINDOW),
+        'start_time': 1.5
+    }
+    tutorbot.sessions['s4'] = session_data
+
+    raw = tutorbot.redis_client.get('tutorbot:session:s4')
+    assert tutorbot.orjson.loads(raw)['context'] == ['Tutor: Hello!']
+
+    loaded = tutorbot.sessions['s4']
+    assert isinstance(loaded['context'], tutorbot.deque)
+    assert loaded['context'].maxlen == tutorbot.CONTEXT_WINDOW
+    assert list(loaded['context']) == ['Tutor: Hello!']
+    assert loaded['start_time'] == 1.5
+
+def test_concurrent_completions_keep_every_summary(monkeypatch):
+    make_lesson('T')
+
+    # Widen the lesson read-modify-write window so unlocked updates would collide
+    get = tutorbot.RedisStore.get
+    def slow_get(self, key, default=None):
+        value = get(self, key, default)
+        time.sleep(0.01)
+        return value
+    monkeypatch.setattr(tutorbot.RedisStore, 'get', slow_get)
+
+    statuses = []
+
+    def student():
+        client = tutorbot.app.test_client()
+        client.post('/student', data={'token': 'T'})
+        statuses.append(client.post('/complete', data={'rating': '4'}).status_code)
+
+    threads = [threading.Thread(target=student) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    lesson = tutorbot.lessons['T']
+    assert statuses == [200] * 8
+    assert len(lesson['sessions']) == 8
+    assert lesson['rating_sum'] == 32.0
+    assert lesson['rating_count'] == 8
+
+def test_completion_with_expired_lesson_keeps_the_session():
+    make_lesson('T')
+    client = tutorbot.app.test_client()
+    client.post('/student', data={'token': 'T'})
+    with client.session_transaction() as flask_session:
+        session_id = flask_session['session_id']
+
+    tutorbot.lessons.pop('T')
+    assert client.post('/complete', data={'rating': '4'}).status_code == 404
+    assert session_id in tutorbot.sessions
+
+class FakeClient:
+    """Stands in for SafeInferenceClient, recording single and batched calls"""
+    def __init__(self, batch_result=None):
+        self.batch_result = batch_result
+        self.singles = []
+        self.batches = []
+
+    def _generate(self, prompt, max_tokens, temperature, max_retries):
+        time.sleep(0.05)
+        self.singles.append(prompt)
+        return f"single:{prompt}"
+
+    def _generate_batch(self, prompts, max_tokens, temperature):
+        time.sleep(0.05)
+        self.batches.append(list(prompts))
+        if self.batch_result is None:
+            return None
+        return [self.batch_result(prompt) for prompt in prompts]
+
+def submit_concurrently(batcher, count):
+    results = {}
+
+    def call(i):
+        results[i] = batcher.submit(f"p{i}", 10, 0.5, 1)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.002)
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_lone_call_is_sent_without_waiting():
+    client = FakeClient(batch_result=lambda prompt: f"batch:{prompt}")
+    batcher = tutorbot.InferenceBatcher(client, max_batch=8, max_wait_ms=200)
+
+    started = time.perf_counter()
+    assert batcher.submit('alone', 10, 0.5, 1) == 'single:alone'
+    assert time.perf_counter() - started < 0.15
+    assert client.batches == []
+
+def test_overlapping_calls_share_a_batch():
+    client = FakeClient(batch_result=lambda prompt: f"batch:{prompt}")
+    batcher = tutorbot.InferenceBatcher(client, max_batch=8, max_wait_ms=20)
+
+    results = submit_concurrently(batcher, 6)
+    assert results[0] == 'single:p0'
+    assert all(results[i] == f"batch:p{i}" for i in range(1, 6))
+    assert client.batches == [['p1', 'p2', 'p3', 'p4', 'p5']]
+
+def test_failed_batches_fall_back_to_single_calls_then_disable_batching():
+    client = FakeClient(batch_result=None)
+    batcher = tutorbot.InferenceBatcher(client, max_batch=8, max_wait_ms=20, max_failures=3)
+
+    for _ in range(3):
+        results = submit_concurrently(batcher, 3)
+        assert results == {i: f"single:p{i}" for i in range(3)}
+    assert not batcher.enabled
+
+    batches_sent = len(client.batches)
+    submit_concurrently(batcher, 3)
+    assert len(client.batches) == batches_sent
+
+def test_missing_batch_items_fall_back_individually():
+    client = FakeClient(batch_result=lambda prompt: None if prompt == 'p2' else f"batch:{prompt}")
+    batcher = tutorbot.InferenceBatcher(client, max_batch=8, max_wait_ms=20)
+
+    results = submit_concurrently(batcher, 4)
+    assert results[2] == 'single:p2'
+    assert results[3] == 'batch:p3'